@@ -1,25 +1,99 @@
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
-from qwen_vl_utils import process_vision_info
+from starlette.background import BackgroundTask
+from transformers import (
+    Qwen2VLForConditionalGeneration,
+    AutoProcessor,
+    GenerationConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    AsyncTextIteratorStreamer,
+)
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
 import torch
+from torchvision.transforms import InterpolationMode, v2
+from torchvision.transforms.v2.functional import pil_to_tensor
 from PIL import Image
 import io
+import os
+import orjson
+import asyncio
+import importlib.util
 import httpx
 import base64
+import copy
+import hashlib
+import threading
 import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
 from typing import List, Dict, Any, Optional, Union
 
 
-app = FastAPI(title="Holo1.5-7B Vision Language Model API (OpenAI Compatible)")
+app = FastAPI(
+    title="Holo1.5-7B Vision Language Model API (OpenAI Compatible)",
+    default_response_class=ORJSONResponse
+)
 
 # Global variables for model and processor
 model = None
 processor = None
 device = None
+copy_stream = None
+# Generation configs built at startup, keyed by max_new_tokens bucket
+generation_configs = {}
+# Set once the model is loaded and warmed up
+READY = False
 MODEL_NAME = "Hcompany/Holo1.5-7B"
+DEFAULT_MAX_TOKENS = 512
+
+# Compile the model forward pass with TorchInductor (CUDA only)
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "1") == "1"
+TORCH_COMPILE_MODE = os.environ.get("TORCH_COMPILE_MODE", "reduce-overhead")
+
+# TorchAO weight quantization of the language decoder (CUDA only):
+# "int8_dynamic", "int8_weight_only" or "none"
+QUANTIZATION = os.environ.get("QUANTIZATION", "int8_dynamic")
+
+# Prompts are left-padded to a multiple of this length so the static KV cache
+# and compiled graphs only ever see a small set of input shapes
+PROMPT_BUCKET = 64
+
+# Concurrent chat completions are coalesced into one generate call of up to
+# MAX_BATCH_SIZE prompts, waiting at most MAX_BATCH_WAIT_MS for the batch to fill
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+MAX_BATCH_WAIT_MS = float(os.environ.get("MAX_BATCH_WAIT_MS", "5"))
+
+# Batches are padded with placeholder rows up to one of these sizes (powers of
+# two, capped at MAX_BATCH_SIZE): a new batch size rebuilds the static cache
+# and recompiles, so only these sizes are warmed up and ever reach generate
+BATCH_SIZE_BUCKETS = tuple(sorted({
+    min(2 ** exponent, MAX_BATCH_SIZE) for exponent in range(MAX_BATCH_SIZE.bit_length() + 1)
+}))
+
+# max_tokens is rounded up to one of these buckets so generate always receives
+# one of a few pre-built configs, keeping compiled graph signatures stable
+MAX_TOKENS_BUCKETS = (64, 128, 256, 512, 1024)
+
+# Every generate call (and the warm-up) runs on this one thread: batched and
+# streamed requests share the model and its static cache, and Inductor keeps
+# its CUDA graphs per thread, so warm-up only carries over on the same thread
+generate_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate")
+
+# Images can be downscaled so their longest side is at most MAX_IMAGE_EDGE pixels
+# before preprocessing. Off by default (0): the model returns pixel coordinates,
+# which would then refer to the resized image
+MAX_IMAGE_EDGE = int(os.environ.get("MAX_IMAGE_EDGE", "0"))
+
+# Decoded base64 images are kept by content hash so retries and repeated
+# payloads skip the decode
+IMAGE_CACHE_SIZE = 32
+image_cache: "OrderedDict[bytes, Image.Image]" = OrderedDict()
+image_cache_lock = threading.Lock()
 
 
 # Pydantic models for OpenAI-compatible API
@@ -46,15 +120,23 @@ class Message(BaseModel):
 class ChatCompletionRequest(BaseModel):
     model: str
     messages: List[Message]
-    max_tokens: Optional[int] = 512
+    max_tokens: Optional[int] = DEFAULT_MAX_TOKENS
     temperature: Optional[float] = 0.7
     stream: Optional[bool] = False
 
 
+@dataclass
+class PendingGeneration:
+    """A prepared prompt waiting in the batch queue for its generate result"""
+    inputs: Dict[str, Any]
+    max_new_tokens: int
+    future: asyncio.Future
+
+
 @app.on_event("startup")
 async def load_model():
     """Load the Holo1.5-7B model on startup"""
-    global model, processor, device
+    global model, processor, device, copy_stream, READY
 
     print("Loading Holo1.5-7B model...")
 
@@ -62,21 +144,174 @@ async def load_model():
     device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"Using device: {device}")
 
+    # Use fused attention kernels: FlashAttention-2 when installed, PyTorch SDPA otherwise
+    attn_implementation = "sdpa"
+    if device == "cuda":
+        if importlib.util.find_spec("flash_attn") is not None:
+            attn_implementation = "flash_attention_2"
+        # Keep the math kernel enabled as a fallback for shapes the fused kernels reject
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+    print(f"Using attention implementation: {attn_implementation}")
+
     # Load model and processor
+    # The bf16 weights (~14GB) fit on a single GPU. Mapping the whole model to
+    # one device loads the weights straight onto it, without staging them in
+    # host RAM and without the per-layer dispatch hooks of device_map="auto"
     model = Qwen2VLForConditionalGeneration.from_pretrained(
         MODEL_NAME,
         torch_dtype=torch.bfloat16 if device == "cuda" else torch.float32,
-        device_map="auto" if device == "cuda" else None
+        device_map=device,
+        attn_implementation=attn_implementation
     )
 
-    if device == "cpu":
-        model = model.to(device)
+    model.eval()
 
     processor = AutoProcessor.from_pretrained(MODEL_NAME)
+    processor.tokenizer.padding_side = "left"
+
+    if device == "cuda":
+        # Side stream for host-to-device input copies
+        copy_stream = torch.cuda.Stream()
 
+        # Pre-allocated KV cache with fixed shapes lets CUDA graphs capture the decode step
+        model.generation_config.cache_implementation = "static"
+        # generate() would otherwise compile the forward pass itself whenever a
+        # static cache is used; compilation is controlled by TORCH_COMPILE only
+        model.generation_config.disable_compile = True
+
+    for bucket in MAX_TOKENS_BUCKETS:
+        generation_configs[bucket] = build_generation_config(bucket)
+
+    if device == "cuda" and QUANTIZATION != "none":
+        quantize_model()
+
+    if device == "cuda" and TORCH_COMPILE:
+        if QUANTIZATION != "none":
+            from torchao.utils import unwrap_tensor_subclass
+            unwrap_tensor_subclass(model)
+
+        # generate() calls self.forward, so compile the bound forward rather than
+        # wrapping the module: both endpoints keep using the same `model` global
+        print(f"Compiling model with torch.compile (mode={TORCH_COMPILE_MODE})...")
+        model.forward = torch.compile(model.forward, mode=TORCH_COMPILE_MODE, fullgraph=False)
+
+    if device == "cuda":
+        await asyncio.get_running_loop().run_in_executor(generate_executor, warmup_model)
+
+    READY = True
     print("Model loaded successfully!")
 
 
+@app.on_event("startup")
+async def create_http_client():
+    """Create the pooled HTTP client used to fetch image URLs"""
+    app.state.http = httpx.AsyncClient(
+        timeout=30.0,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+    )
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    """Close the pooled HTTP client"""
+    await app.state.http.aclose()
+
+
+def build_generation_config(max_new_tokens: int) -> GenerationConfig:
+    """Build a generation config from the model defaults for a token budget"""
+    config = copy.deepcopy(model.generation_config)
+    config.update(
+        max_new_tokens=max_new_tokens,
+        pad_token_id=processor.tokenizer.pad_token_id,
+        use_cache=True,
+    )
+    return config
+
+
+def get_generation_config(max_new_tokens: int) -> GenerationConfig:
+    """Return the pre-built config of the smallest bucket that fits max_new_tokens"""
+    for bucket in MAX_TOKENS_BUCKETS:
+        if max_new_tokens <= bucket:
+            return generation_configs[bucket]
+
+    raise ValueError(f"max_new_tokens {max_new_tokens} exceeds {MAX_TOKENS_BUCKETS[-1]}")
+
+
+def get_max_tokens(request: ChatCompletionRequest) -> int:
+    """Return the request's token budget, rejecting values outside the buckets"""
+    max_tokens = DEFAULT_MAX_TOKENS if request.max_tokens is None else request.max_tokens
+
+    # The static cache and compiled graphs are sized for the largest bucket
+    if not 1 <= max_tokens <= MAX_TOKENS_BUCKETS[-1]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"max_tokens must be between 1 and {MAX_TOKENS_BUCKETS[-1]}",
+        )
+
+    return max_tokens
+
+
+def quantize_model():
+    """Quantize the language decoder linear layers to int8 with TorchAO"""
+    from torchao.quantization.quant_api import (
+        quantize_,
+        Int8DynamicActivationInt8WeightConfig,
+        Int8WeightOnlyConfig,
+    )
+
+    configs = {
+        "int8_dynamic": Int8DynamicActivationInt8WeightConfig,
+        "int8_weight_only": Int8WeightOnlyConfig,
+    }
+    if QUANTIZATION not in configs:
+        raise ValueError(f"Unknown QUANTIZATION mode: {QUANTIZATION}")
+
+    print(f"Quantizing language decoder ({QUANTIZATION})...")
+
+    # The vision encoder and lm_head stay in bf16: localization quality is
+    # sensitive to the encoder, and the output logits pick exact coordinate tokens
+    quantize_(
+        model,
+        configs[QUANTIZATION](),
+        filter_fn=lambda module, fqn: (
+            isinstance(module, torch.nn.Linear) and "visual" not in fqn and fqn != "lm_head"
+        ),
+    )
+
+
+def warmup_model():
+    """Run short generate passes so compilation and autotuning happen before serving traffic"""
+    print("Warming up model...")
+    start_time = time.time()
+
+    dummy_image = Image.new("RGB", (1920, 1080), color="white")
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "image", "image": dummy_image},
+                {"type": "text", "text": "Describe this image."}
+            ]
+        }
+    ]
+
+    text_prompt = processor.apply_chat_template(
+        messages, tokenize=False, add_generation_prompt=True
+    )
+    prepared = prepare_inputs(text_prompt, [dummy_image])
+
+    # Each batch size gets its own static cache and graphs; the second pass
+    # runs on the already compiled and autotuned path
+    for batch_size in BATCH_SIZE_BUCKETS:
+        for _ in range(2):
+            rows, limits = pad_batch([prepared], [DEFAULT_MAX_TOKENS], batch_size)
+            generate_batch(collate_inputs(rows), limits)
+
+    print(f"Warm-up finished in {time.time() - start_time:.1f}s")
+
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
@@ -115,21 +350,397 @@ async def list_models():
     }
 
 
+def decode_image(image_data: bytes) -> Image.Image:
+    """Decode image bytes into an RGB PIL image"""
+    # convert() forces the full decode, so this is the CPU-heavy part
+    image = Image.open(io.BytesIO(image_data)).convert("RGB")
+
+    # Vision tokens grow with the pixel count, so cap oversized screenshots
+    if MAX_IMAGE_EDGE > 0:
+        image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+
+    return image
+
+
+def decode_data_url(url: str) -> Image.Image:
+    """Decode a base64 data URL, reusing the result for payloads seen recently"""
+    # Work on a view past the header instead of splitting out a copy of the payload
+    url_bytes = url.encode("ascii")
+    base64_data = memoryview(url_bytes)[url_bytes.index(b",") + 1:]
+    key = hashlib.sha256(base64_data).digest()
+
+    with image_cache_lock:
+        if key in image_cache:
+            image_cache.move_to_end(key)
+            return image_cache[key]
+
+    image = decode_image(base64.b64decode(base64_data))
+
+    with image_cache_lock:
+        image_cache[key] = image
+        while len(image_cache) > IMAGE_CACHE_SIZE:
+            image_cache.popitem(last=False)
+
+    return image
+
+
+def chat_template_key(qwen_messages: List[Dict[str, Any]]) -> tuple:
+    """Normalize messages into a hashable key for the chat template cache"""
+    # Images only render as placeholder tokens, so their pixels don't matter here
+    return tuple(
+        (
+            message["role"],
+            tuple(part["text"] if part["type"] == "text" else None for part in message["content"])
+        )
+        for message in qwen_messages
+    )
+
+
+@lru_cache(maxsize=1024)
+def render_chat_template(messages_key: tuple) -> str:
+    """Render the chat template for a conversation key from chat_template_key"""
+    messages = [
+        {
+            "role": role,
+            "content": [
+                {"type": "image"} if text is None else {"type": "text", "text": text}
+                for text in parts
+            ]
+        }
+        for role, parts in messages_key
+    ]
+    return processor.apply_chat_template(
+        messages, tokenize=False, add_generation_prompt=True
+    )
+
+
+def split_system_prefix(text_prompt: str) -> tuple[str, str]:
+    """Split a rendered ChatML prompt into its leading system turn and the rest"""
+    if text_prompt.startswith("<|im_start|>system"):
+        end = text_prompt.find("<|im_end|>\n")
+        if end != -1:
+            end += len("<|im_end|>\n")
+            # Image placeholders must stay with the processor, which expands them
+            if processor.image_token not in text_prompt[:end]:
+                return text_prompt[:end], text_prompt[end:]
+
+    return "", text_prompt
+
+
+@lru_cache(maxsize=256)
+def tokenize_prefix(prefix: str) -> tuple:
+    """Token ids of a system prefix, cached across requests"""
+    # The prefix ends right before a special token, so these ids match the
+    # ones tokenizing the full prompt would produce
+    return tuple(processor.tokenizer(prefix, add_special_tokens=False).input_ids)
+
+
+class StreamStoppingCriteria(StoppingCriteria):
+    """Stop generation once the given event is set or the sequence reaches max_length"""
+
+    def __init__(self, stop_event: threading.Event, max_length: int):
+        self.stop_event = stop_event
+        self.max_length = max_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = self.stop_event.is_set() or input_ids.shape[1] >= self.max_length
+        return torch.full(
+            (input_ids.shape[0],), done, dtype=torch.bool, device=input_ids.device
+        )
+
+
+class TokenLimitCriteria(StoppingCriteria):
+    """Stop each row once it has generated its own number of new tokens"""
+
+    def __init__(self, prompt_length: int, limits: torch.Tensor):
+        self.prompt_length = prompt_length
+        self.limits = limits
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return input_ids.shape[1] >= self.prompt_length + self.limits
+
+
+def upload(tensor: torch.Tensor) -> torch.Tensor:
+    """Copy a CPU tensor to the model device"""
+    if device != "cuda":
+        return tensor.to(device)
+
+    # Copy from pinned memory on a side stream so the upload overlaps with a
+    # generate call that may still be running on the default stream
+    with torch.cuda.stream(copy_stream):
+        tensor = tensor.pin_memory().to(device, non_blocking=True)
+
+    compute_stream = torch.cuda.current_stream()
+    compute_stream.wait_stream(copy_stream)
+    # The tensor is used on the compute stream, not the stream that allocated it
+    tensor.record_stream(compute_stream)
+
+    return tensor
+
+
+@lru_cache(maxsize=64)
+def get_inference_transform(height: int, width: int) -> v2.Compose:
+    """Resize and normalize a uint8 image tensor like the model's image processor"""
+    image_processor = processor.image_processor
+    return v2.Compose([
+        v2.ToImage(),
+        v2.Resize((height, width), interpolation=InterpolationMode.BICUBIC, antialias=True),
+        v2.ToDtype(torch.float32, scale=True),
+        v2.Normalize(mean=image_processor.image_mean, std=image_processor.image_std),
+    ])
+
+
+def preprocess_image(image: Image.Image) -> tuple[torch.Tensor, List[int]]:
+    """Turn an image into flattened vision patches on the model device"""
+    image_processor = processor.image_processor
+    patch_size = image_processor.patch_size
+    merge_size = image_processor.merge_size
+    temporal_patch_size = image_processor.temporal_patch_size
+
+    height, width = smart_resize(
+        image.height,
+        image.width,
+        factor=patch_size * merge_size,
+        min_pixels=image_processor.min_pixels,
+        max_pixels=image_processor.max_pixels,
+    )
+
+    # Only the raw uint8 pixels cross PCIe; resize and normalize run on the device
+    pixels = upload(pil_to_tensor(image))
+    pixels = get_inference_transform(height, width)(pixels).as_subclass(torch.Tensor)
+
+    # Same patch layout as the image processor: a still image fills the
+    # temporal patch by repetition, and merged patches are kept contiguous
+    channels = pixels.shape[0]
+    grid_h, grid_w = height // patch_size, width // patch_size
+    patches = pixels.unsqueeze(0).expand(temporal_patch_size, -1, -1, -1)
+    patches = patches.reshape(
+        1, temporal_patch_size, channels,
+        grid_h // merge_size, merge_size, patch_size,
+        grid_w // merge_size, merge_size, patch_size,
+    )
+    patches = patches.permute(0, 3, 6, 4, 7, 2, 1, 5, 8)
+    patches = patches.reshape(grid_h * grid_w, channels * temporal_patch_size * patch_size * patch_size)
+
+    return patches, [1, grid_h, grid_w]
+
+
+def prepare_inputs(text_prompt: str, images: List[Image.Image]) -> Dict[str, Any]:
+    """Tokenize a prompt and preprocess its images into unpadded model inputs"""
+    image_token = processor.image_token
+    merge_length = processor.image_processor.merge_size ** 2
+    pixel_values = []
+    image_grid_thw = []
+
+    # The system turn is tokenized once and reused
+    prefix, suffix = split_system_prefix(text_prompt)
+
+    # Expand each image placeholder to one token per merged patch
+    parts = suffix.split(image_token)
+    if len(parts) - 1 != len(images):
+        raise ValueError(
+            f"Prompt has {len(parts) - 1} image placeholders but {len(images)} images"
+        )
+
+    suffix = parts[0]
+    for image, part in zip(images, parts[1:]):
+        patches, grid_thw = preprocess_image(image)
+        pixel_values.append(patches)
+        image_grid_thw.append(grid_thw)
+        suffix += image_token * (grid_thw[0] * grid_thw[1] * grid_thw[2] // merge_length) + part
+
+    suffix_ids = processor.tokenizer(suffix, add_special_tokens=False).input_ids
+
+    return {
+        "input_ids": list(tokenize_prefix(prefix)) + suffix_ids,
+        "pixel_values": pixel_values,
+        "image_grid_thw": image_grid_thw,
+    }
+
+
+def collate_inputs(prepared: List[Dict[str, Any]]):
+    """Pad prepared prompts into a single batch of model inputs"""
+    inputs = processor.tokenizer.pad(
+        {"input_ids": [item["input_ids"] for item in prepared]},
+        padding=True,
+        pad_to_multiple_of=PROMPT_BUCKET,
+        return_tensors="pt",
+    )
+    inputs["input_ids"] = upload(inputs["input_ids"])
+    inputs["attention_mask"] = upload(inputs["attention_mask"])
+
+    pixel_values = [patches for item in prepared for patches in item["pixel_values"]]
+    if pixel_values:
+        inputs["pixel_values"] = torch.cat(pixel_values)
+        inputs["image_grid_thw"] = torch.tensor(
+            [grid for item in prepared for grid in item["image_grid_thw"]], device=device
+        )
+
+    return inputs
+
+
+def pad_batch(
+    prepared: List[Dict[str, Any]],
+    max_new_tokens: List[int],
+    batch_size: Optional[int] = None,
+) -> tuple[List[Dict[str, Any]], List[int]]:
+    """Pad a batch with one-token placeholder rows up to a batch size bucket"""
+    if batch_size is None:
+        batch_size = next(size for size in BATCH_SIZE_BUCKETS if size >= len(prepared))
+
+    # Placeholder rows stop after one token; their results are discarded
+    padding = batch_size - len(prepared)
+    placeholder = {
+        "input_ids": [processor.tokenizer.pad_token_id],
+        "pixel_values": [],
+        "image_grid_thw": [],
+    }
+
+    return prepared + [placeholder] * padding, max_new_tokens + [1] * padding
+
+
+def generate_batch(inputs, max_new_tokens: List[int]) -> List[Dict[str, Any]]:
+    """Run a single padded generate call over several prepared prompts"""
+    pad_token_id = processor.tokenizer.pad_token_id
+    prompt_length = inputs.input_ids.shape[1]
+    limits = torch.tensor(max_new_tokens, device=inputs.input_ids.device)
+
+    # The bucketed config may allow more tokens than requested, so each row
+    # stops at its own limit and the batch ends once every row is done
+    stopping_criteria = StoppingCriteriaList([TokenLimitCriteria(prompt_length, limits)])
+
+    with torch.no_grad():
+        generated_ids = model.generate(
+            **inputs,
+            generation_config=get_generation_config(max(max_new_tokens)),
+            stopping_criteria=stopping_criteria,
+        )
+
+    # Trim the input tokens from the generated output; left padding gives
+    # every row the same prompt length
+    generated_ids_trimmed = generated_ids[:, prompt_length:]
+
+    # Safety net: blank out anything past a row's limit so it is skipped like
+    # the padding of rows that stopped early
+    positions = torch.arange(generated_ids_trimmed.shape[1], device=generated_ids_trimmed.device)
+    generated_ids_trimmed = generated_ids_trimmed.masked_fill(
+        positions[None, :] >= limits[:, None], pad_token_id
+    )
+
+    # Decode the output
+    output_texts = processor.batch_decode(
+        generated_ids_trimmed,
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=False
+    )
+
+    # Bucket padding is not part of the prompt
+    prompt_tokens = inputs.attention_mask.sum(dim=1).tolist()
+    completion_tokens = (generated_ids_trimmed != pad_token_id).sum(dim=1).tolist()
+
+    results = [
+        {
+            "text": output_text,
+            "prompt_tokens": prompt_count,
+            "completion_tokens": completion_count,
+        }
+        for output_text, prompt_count, completion_count
+        in zip(output_texts, prompt_tokens, completion_tokens)
+    ]
+
+    return results
+
+
+def generate_stream(
+    inputs,
+    max_new_tokens: int,
+    streamer: AsyncTextIteratorStreamer,
+    stop_event: threading.Event,
+):
+    """Generate a single prepared prompt, pushing decoded text to the streamer"""
+    # The client may have gone away while the stream waited for the generate thread
+    if stop_event.is_set():
+        streamer.end()
+        return
+
+    # The bucketed config may allow more tokens than requested, so the exact
+    # limit is enforced by the stopping criteria
+    stopping_criteria = StoppingCriteriaList([
+        StreamStoppingCriteria(stop_event, inputs.input_ids.shape[1] + max_new_tokens)
+    ])
+
+    with torch.no_grad():
+        model.generate(
+            **inputs,
+            generation_config=get_generation_config(max_new_tokens),
+            streamer=streamer,
+            stopping_criteria=stopping_criteria,
+        )
+
+
+async def batch_worker(queue: asyncio.Queue):
+    """Coalesce queued prompts into batches and resolve each caller's future"""
+    while True:
+        batch = [await queue.get()]
+
+        # Give concurrent requests a short window to join the batch
+        await asyncio.sleep(MAX_BATCH_WAIT_MS / 1000)
+        while len(batch) < MAX_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        # Skip callers that disconnected while waiting
+        batch = [pending for pending in batch if not pending.future.cancelled()]
+        if not batch:
+            continue
+
+        try:
+            # Each prompt was prepared by its own request, so only padding is left
+            rows, limits = pad_batch(
+                [pending.inputs for pending in batch],
+                [pending.max_new_tokens for pending in batch],
+            )
+            results = await asyncio.get_running_loop().run_in_executor(
+                generate_executor,
+                generate_batch,
+                collate_inputs(rows),
+                limits,
+            )
+        except Exception as e:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+        else:
+            for pending, result in zip(batch, results):
+                if not pending.future.done():
+                    pending.future.set_result(result)
+
+
+@app.on_event("startup")
+async def start_batch_worker():
+    """Start the background task that batches generate calls"""
+    app.state.batch_queue = asyncio.Queue()
+    app.state.batch_worker = asyncio.create_task(batch_worker(app.state.batch_queue))
+
+
+@app.on_event("shutdown")
+async def stop_batch_worker():
+    """Stop the batching task"""
+    app.state.batch_worker.cancel()
+
+
 async def fetch_image_from_url(url: str) -> Image.Image:
     """Fetch an image from a URL or decode from base64"""
     try:
         # Check if it's a base64 data URL
         if url.startswith("data:image"):
-            # Extract base64 data
-            header, base64_data = url.split(",", 1)
-            image_data = base64.b64decode(base64_data)
-            return Image.open(io.BytesIO(image_data))
-
-        # Otherwise, fetch from URL
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            return Image.open(io.BytesIO(response.content))
+            return await asyncio.to_thread(decode_data_url, url)
+
+        # Otherwise, fetch from URL, reusing pooled connections
+        response = await app.state.http.get(url)
+        response.raise_for_status()
+
+        # Decode off the event loop so concurrent requests keep being served
+        return await asyncio.to_thread(decode_image, response.content)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to fetch image: {str(e)}")
 
@@ -155,105 +766,87 @@ def parse_message_content(content: Union[str, List[Any]]) -> tuple[List[Image.Im
     return images, " ".join(texts)
 
 
-@app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
-    """
-    OpenAI-compatible chat completions endpoint
+async def prepare_prompt(request: ChatCompletionRequest) -> tuple[str, List[Image.Image]]:
+    """Render the Qwen2-VL prompt and fetch the images of a chat request"""
+    # Build messages in Qwen2-VL format
+    qwen_messages = []
+    image_fetches = []
 
-    Supports:
-    - Image URLs (http/https)
-    - Base64 encoded images (data:image/...)
-    - Text prompts
-    """
-    if model is None or processor is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
+    for message in request.messages:
+        if message.role not in ["user", "assistant", "system"]:
+            continue
 
-    if request.stream:
-        raise HTTPException(status_code=400, detail="Streaming not supported yet")
+        content_parts = []
 
-    try:
-        # Build messages in Qwen2-VL format
-        qwen_messages = []
-
-        for message in request.messages:
-            if message.role not in ["user", "assistant", "system"]:
-                continue
-
-            content_parts = []
-
-            if isinstance(message.content, str):
-                # Simple text message
-                content_parts.append({"type": "text", "text": message.content})
-            elif isinstance(message.content, list):
-                # Multimodal message
-                for item in message.content:
-                    item_dict = item if isinstance(item, dict) else item.dict()
-
-                    if item_dict.get("type") == "text":
-                        content_parts.append({"type": "text", "text": item_dict.get("text", "")})
-
-                    elif item_dict.get("type") == "image_url":
-                        # Fetch the image
-                        image_url_data = item_dict.get("image_url", {})
-                        if isinstance(image_url_data, dict):
-                            url = image_url_data.get("url", "")
-                        else:
-                            url = image_url_data
-
-                        if url:
-                            pil_image = await fetch_image_from_url(url)
-
-                            # Convert RGBA to RGB if necessary
-                            if pil_image.mode == 'RGBA':
-                                pil_image = pil_image.convert('RGB')
-
-                            content_parts.append({"type": "image", "image": pil_image})
-
-            if content_parts:
-                qwen_messages.append({
-                    "role": message.role,
-                    "content": content_parts
-                })
-
-        if not qwen_messages:
-            raise HTTPException(status_code=400, detail="No valid messages provided")
-
-        # Prepare inputs using processor
-        text_prompt = processor.apply_chat_template(
-            qwen_messages, tokenize=False, add_generation_prompt=True
-        )
+        if isinstance(message.content, str):
+            # Simple text message
+            content_parts.append({"type": "text", "text": message.content})
+        elif isinstance(message.content, list):
+            # Multimodal message
+            for item in message.content:
+                item_dict = item if isinstance(item, dict) else item.dict()
 
-        image_inputs, video_inputs = process_vision_info(qwen_messages)
+                if item_dict.get("type") == "text":
+                    content_parts.append({"type": "text", "text": item_dict.get("text", "")})
 
-        inputs = processor(
-            text=[text_prompt],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
+                elif item_dict.get("type") == "image_url":
+                    # Fetch the image
+                    image_url_data = item_dict.get("image_url", {})
+                    if isinstance(image_url_data, dict):
+                        url = image_url_data.get("url", "")
+                    else:
+                        url = image_url_data
 
-        inputs = inputs.to(device)
+                    if url:
+                        # The template only needs a placeholder; the images
+                        # themselves go straight to the processor, in order
+                        content_parts.append({"type": "image"})
+                        image_fetches.append(fetch_image_from_url(url))
 
-        # Generate response
-        with torch.no_grad():
-            generated_ids = model.generate(
-                **inputs,
-                max_new_tokens=request.max_tokens,
-            )
+        if content_parts:
+            qwen_messages.append({
+                "role": message.role,
+                "content": content_parts
+            })
 
-        # Trim the input tokens from the generated output
-        generated_ids_trimmed = [
-            out_ids[len(in_ids):]
-            for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-        ]
+    # Fetch and decode all images concurrently
+    images = await asyncio.gather(*image_fetches)
+
+    if not qwen_messages:
+        raise HTTPException(status_code=400, detail="No valid messages provided")
+
+    # Prepare inputs using processor
+    text_prompt = render_chat_template(chat_template_key(qwen_messages))
+
+    return text_prompt, list(images)
+
+
+async def create_chat_completion(request: ChatCompletionRequest) -> Dict[str, Any]:
+    """Run a chat completion and return the OpenAI-style response body"""
+    if not READY:
+        raise HTTPException(status_code=503, detail="Model not loaded")
 
-        # Decode the output
-        output_text = processor.batch_decode(
-            generated_ids_trimmed,
-            skip_special_tokens=True,
-            clean_up_tokenization_spaces=False
-        )[0]
+    max_tokens = get_max_tokens(request)
+
+    try:
+        text_prompt, images = await prepare_prompt(request)
+
+        # Prepared off the event loop and outside the batch, so a bad image or
+        # prompt fails only this request
+        try:
+            inputs = await asyncio.to_thread(prepare_inputs, text_prompt, images)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid input: {str(e)}")
+
+        # Queue the prompt for the batch worker and wait for its result
+        future = asyncio.get_running_loop().create_future()
+        await app.state.batch_queue.put(
+            PendingGeneration(inputs, max_tokens, future)
+        )
+        result = await future
+
+        prompt_tokens = result["prompt_tokens"]
+        completion_tokens = result["completion_tokens"]
 
         # Format response in OpenAI style
         response = {
@@ -266,19 +859,19 @@ async def chat_completions(request: ChatCompletionRequest):
                     "index": 0,
                     "message": {
                         "role": "assistant",
-                        "content": output_text
+                        "content": result["text"]
                     },
                     "finish_reason": "stop"
                 }
             ],
             "usage": {
-                "prompt_tokens": len(inputs.input_ids[0]),
-                "completion_tokens": len(generated_ids_trimmed[0]),
-                "total_tokens": len(inputs.input_ids[0]) + len(generated_ids_trimmed[0])
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
             }
         }
 
-        return JSONResponse(content=response)
+        return response
 
     except HTTPException:
         raise
@@ -286,6 +879,116 @@ async def chat_completions(request: ChatCompletionRequest):
         raise HTTPException(status_code=500, detail=f"Prediction error: {str(e)}")
 
 
+async def stream_chat_completion(request: ChatCompletionRequest) -> StreamingResponse:
+    """Start a streamed chat completion and return its server-sent events response"""
+    if not READY:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+
+    max_tokens = get_max_tokens(request)
+
+    try:
+        text_prompt, images = await prepare_prompt(request)
+        inputs = collate_inputs([await asyncio.to_thread(prepare_inputs, text_prompt, images)])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid input: {str(e)}")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Prediction error: {str(e)}")
+
+    streamer = AsyncTextIteratorStreamer(
+        processor.tokenizer, skip_prompt=True, skip_special_tokens=True
+    )
+    stop_event = threading.Event()
+
+    async def run_generation():
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                generate_executor,
+                generate_stream,
+                inputs,
+                max_tokens,
+                streamer,
+                stop_event,
+            )
+        except Exception:
+            # Unblock the consumer, which is waiting for more text
+            streamer.end()
+            raise
+
+    # Streams bypass the batch queue and decode on their own
+    generation = asyncio.create_task(run_generation())
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    created = int(time.time())
+
+    def chunk(delta: Dict[str, str], finish_reason: Optional[str] = None) -> bytes:
+        body = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": request.model,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": delta,
+                    "finish_reason": finish_reason
+                }
+            ]
+        }
+        return b"data: " + orjson.dumps(body) + b"\n\n"
+
+    async def events():
+        try:
+            yield chunk({"role": "assistant"})
+
+            async for text in streamer:
+                if text:
+                    yield chunk({"content": text})
+
+            try:
+                await generation
+            except Exception as e:
+                # The 200 header is already out, so report the failure in-band
+                error = {"error": {"message": f"Prediction error: {str(e)}", "type": "server_error"}}
+                yield b"data: " + orjson.dumps(error) + b"\n\n"
+                return
+
+            yield chunk({}, "stop")
+            yield b"data: [DONE]\n\n"
+        finally:
+            # Stops generate() early when the client disconnects
+            stop_event.set()
+
+    # The background task runs once the response ends, even if the client
+    # disconnected before the generator was ever iterated
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        background=BackgroundTask(stop_event.set),
+    )
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: ChatCompletionRequest):
+    """
+    OpenAI-compatible chat completions endpoint
+
+    Supports:
+    - Image URLs (http/https)
+    - Base64 encoded images (data:image/...)
+    - Text prompts
+    - Streaming (stream=true) as server-sent events
+    """
+    if request.stream:
+        return await stream_chat_completion(request)
+
+    return ORJSONResponse(content=await create_chat_completion(request))
+
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop is not available on Windows, where the default asyncio loop is used
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    # A single worker owns the GPU; concurrency comes from the batch worker
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop=loop, http="auto", workers=1)
@@ -2,38 +2,50 @@
 RunPod Serverless Handler for Holo1.5-7B VLM API
 
 This handler allows the FastAPI service to work with RunPod Serverless.
-It accepts requests in RunPod format and forwards them to the FastAPI app.
+It accepts requests in RunPod format and dispatches them to the FastAPI app
+in-process, without going through HTTP.
 """
 
 import asyncio
-import httpx
-import time
-import os
 from typing import Dict, Any
 
+try:
+    import uvloop
+except ImportError:
+    # Not available on Windows; the default asyncio loop is used instead
+    uvloop = None
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from app.main import app, ChatCompletionRequest, create_chat_completion
+
 
 # Configuration
-API_BASE_URL = os.environ.get("API_BASE_URL", "http://localhost:8000")
 MAX_RETRIES = 3
 RETRY_DELAY = 1  # seconds
 
+# Kept across invocations: the model, batch worker and HTTP client created at
+# startup are bound to this loop
+_event_loop = None
+_service_started = False
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop shared by all handler invocations"""
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    return _event_loop
+
 
-async def wait_for_service(url: str, max_wait: int = 60) -> bool:
-    """Wait for the FastAPI service to be ready"""
-    start_time = time.time()
-    async with httpx.AsyncClient(timeout=5.0) as client:
-        while time.time() - start_time < max_wait:
-            try:
-                response = await client.get(f"{url}/health")
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get("status") == "healthy" and data.get("model_loaded"):
-                        print("✓ Service is ready")
-                        return True
-            except Exception as e:
-                print(f"Waiting for service... ({e})")
-            await asyncio.sleep(2)
-    return False
+async def start_service():
+    """Run the FastAPI startup hooks (model loading, batch worker) once"""
+    global _service_started
+    if not _service_started:
+        await app.router.startup()
+        _service_started = True
+        print("✓ Service is ready")
 
 
 async def process_request(input_data: Dict[str, Any]) -> Dict[str, Any]:
@@ -93,44 +105,45 @@ async def process_request(input_data: Dict[str, Any]) -> Dict[str, Any]:
             "max_tokens": max_tokens
         }
 
-    # Make request to FastAPI service
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        for attempt in range(MAX_RETRIES):
-            try:
-                response = await client.post(
-                    f"{API_BASE_URL}/v1/chat/completions",
-                    json=payload
-                )
-
-                if response.status_code == 200:
-                    result = response.json()
-                    return {
-                        "status": "success",
-                        "output": result
-                    }
-                else:
-                    error_msg = f"API returned status {response.status_code}: {response.text}"
-                    print(f"Attempt {attempt + 1} failed: {error_msg}")
-
-                    if attempt < MAX_RETRIES - 1:
-                        await asyncio.sleep(RETRY_DELAY)
-                    else:
-                        return {
-                            "error": error_msg,
-                            "status": "failed"
-                        }
+    try:
+        request = ChatCompletionRequest(**payload)
+    except ValidationError as e:
+        return {
+            "error": f"Invalid request: {str(e)}",
+            "status": "failed"
+        }
 
-            except Exception as e:
-                error_msg = f"Request failed: {str(e)}"
-                print(f"Attempt {attempt + 1} failed: {error_msg}")
+    await start_service()
 
-                if attempt < MAX_RETRIES - 1:
-                    await asyncio.sleep(RETRY_DELAY)
-                else:
-                    return {
-                        "error": error_msg,
-                        "status": "failed"
-                    }
+    # Call the chat completions logic directly; only internal errors are retried
+    for attempt in range(MAX_RETRIES):
+        try:
+            result = await create_chat_completion(request)
+            return {
+                "status": "success",
+                "output": result
+            }
+
+        except HTTPException as e:
+            error_msg = f"API returned status {e.status_code}: {e.detail}"
+            if e.status_code < 500:
+                return {
+                    "error": error_msg,
+                    "status": "failed"
+                }
+
+        except Exception as e:
+            error_msg = f"Request failed: {str(e)}"
+
+        print(f"Attempt {attempt + 1} failed: {error_msg}")
+
+        if attempt < MAX_RETRIES - 1:
+            await asyncio.sleep(RETRY_DELAY)
+        else:
+            return {
+                "error": error_msg,
+                "status": "failed"
+            }
 
     return {
         "error": "All retry attempts failed",
@@ -171,7 +184,7 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
 
     # Run async processing
     try:
-        result = asyncio.run(process_request(input_data))
+        result = get_event_loop().run_until_complete(process_request(input_data))
         return result
     except Exception as e:
         return {
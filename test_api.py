@@ -12,15 +12,21 @@ Examples:
 import sys
 import requests
 import base64
+import json
 import os
+import uuid
 
 
-def encode_image_to_base64(image_path: str) -> str:
-    """Encode a local image file to base64 data URL"""
-    with open(image_path, "rb") as image_file:
-        image_data = base64.b64encode(image_file.read()).decode('utf-8')
+# Multiple of 3 bytes, so each chunk encodes to base64 without padding
+BASE64_CHUNK_SIZE = 3 * 64 * 1024
+
+# Stands in for a streamed local image's URL; random so it can't collide with
+# anything in the user's query
+IMAGE_PLACEHOLDER = uuid.uuid4().hex
+
 
-    # Determine image type from extension
+def get_mime_type(image_path: str) -> str:
+    """Determine image type from extension"""
     ext = os.path.splitext(image_path)[1].lower()
     mime_types = {
         '.jpg': 'image/jpeg',
@@ -29,9 +35,23 @@ def encode_image_to_base64(image_path: str) -> str:
         '.gif': 'image/gif',
         '.webp': 'image/webp'
     }
-    mime_type = mime_types.get(ext, 'image/jpeg')
+    return mime_types.get(ext, 'image/jpeg')
+
+
+def iter_base64_payload(payload: dict, image_path: str):
+    """
+    Yield the JSON request body with a local image streamed in as a base64 data URL
 
-    return f"data:{mime_type};base64,{image_data}"
+    The payload's image URL must be IMAGE_PLACEHOLDER. The file is read
+    and encoded chunk by chunk, so the full image is never held in memory.
+    """
+    before, after = json.dumps(payload).split(f'"{IMAGE_PLACEHOLDER}"', 1)
+
+    yield f'{before}"data:{get_mime_type(image_path)};base64,'.encode()
+    with open(image_path, "rb") as image_file:
+        while chunk := image_file.read(BASE64_CHUNK_SIZE):
+            yield base64.b64encode(chunk)
+    yield f'"{after}'.encode()
 
 
 def test_api(image_input: str, text_query: str, api_url: str = "http://localhost:8000"):
@@ -59,18 +79,13 @@ def test_api(image_input: str, text_query: str, api_url: str = "http://localhost
     elif image_input.startswith('data:'):
         image_url = image_input
         print("Using base64 data URL")
+    elif os.path.isfile(image_input):
+        # Local file - streamed as base64 while uploading
+        image_url = IMAGE_PLACEHOLDER
+        print("Streaming local file as base64")
     else:
-        # Local file - convert to base64
-        try:
-            print("Converting local file to base64...")
-            image_url = encode_image_to_base64(image_input)
-            print("Conversion successful")
-        except FileNotFoundError:
-            print(f"Error: Image file not found: {image_input}")
-            return
-        except Exception as e:
-            print(f"Error encoding image: {e}")
-            return
+        print(f"Error: Image file not found: {image_input}")
+        return
 
     print("-" * 70)
 
@@ -99,9 +114,14 @@ def test_api(image_input: str, text_query: str, api_url: str = "http://localhost
         }
 
         print("Sending request to /v1/chat/completions...")
+        if image_url == IMAGE_PLACEHOLDER:
+            body = iter_base64_payload(payload, image_input)
+        else:
+            body = json.dumps(payload)
+
         response = requests.post(
             f"{api_url}/v1/chat/completions",
-            json=payload,
+            data=body,
             headers={"Content-Type": "application/json"}
         )
 